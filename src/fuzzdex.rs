@@ -4,14 +4,22 @@ use std::sync::Arc;
 use std::sync::Mutex;
 use std::cmp::Ordering;
 use itertools::Itertools;
+#[cfg(feature = "rayon")]
+use itertools::Either;
 
 use lru::LruCache;
+#[cfg(feature = "rayon")]
+use rayon::prelude::*;
 use super::utils;
 use super::query::Query;
 
 /* Fast hashing, but requires AES-ni extensions */
 type FastHash = ahash::RandomState;
 
+/* Match phrases in parallel when there's more candidates than that */
+#[cfg(feature = "rayon")]
+const PARALLEL_CANDIDATES: usize = 128;
+
 
 /// Query result
 #[derive(Debug, Clone, PartialEq)]
@@ -90,6 +98,8 @@ struct PhraseEntry {
     origin: String,
     /// Tokens that build this phrase.
     tokens: Vec<String>,
+    /// Sketches of tokens for distance prefiltering.
+    sketches: Vec<utils::TokenSketch>,
     /// Constraints with which this phrase is valid.
     constraints: HashSet<usize, FastHash>
 }
@@ -142,9 +152,14 @@ impl Index {
             None => HashSet::with_hasher(FastHash::new())
         };
 
+        let sketches = phrase_tokens.iter()
+            .map(|token| utils::TokenSketch::new(token))
+            .collect();
+
         self.phrases.insert(phrase_idx, PhraseEntry {
             origin: phrase.to_string(),
             tokens: phrase_tokens,
+            sketches,
             constraints,
         });
     }
@@ -266,8 +281,34 @@ impl IndexReady {
         map
     }
 
-    fn filtered_results(&self, query: &Query, heatmap: &Heatmap,
-                        should_scores: HashMap<usize, f32, FastHash>) -> Vec<Result> {
+    /// Iterate over phrase tokens by decreasing trigram score until first
+    /// matching the must token is found.
+    fn valid_token<'a>(query: &Query, must_sketch: &utils::TokenSketch, max_distance: usize,
+                       phrase_heatmap: &PhraseHeatmap, phrase: &'a PhraseEntry)
+                       -> Option<(&'a String, f32, usize)> {
+        phrase_heatmap.tokens
+            .iter()
+            .map(|(&idx, &score)|
+                 (score, &phrase.tokens[idx as usize], &phrase.sketches[idx as usize]))
+            .sorted_by(|(score_a, token_a, _), (score_b, token_b, _)| {
+                /* Prefer shortest for a given score */
+                /* TODO: Maybe score could be divided by token length */
+                let side_a = (score_a, token_b.len());
+                let side_b = (score_b, token_a.len());
+                side_b.partial_cmp(&side_a).unwrap_or(Ordering::Equal)
+            })
+            /* Reject obviously too distant tokens without calculating distance */
+            .filter(|(_score, _token, sketch)| sketch.may_match(must_sketch, max_distance))
+            .map(|(token_score, token, _sketch)| {
+                let distance = utils::distance_bounded(token, &query.must, max_distance);
+                (token, token_score, distance)
+            }).find(|(_token, _score, distance)| {
+                *distance <= max_distance
+            })
+    }
+
+    fn filtered_results<'a>(&'a self, query: &Query, heatmap: &Heatmap,
+                            should_scores: HashMap<usize, f32, FastHash>) -> Vec<Result<'a>> {
         let mut results: Vec<Result> = Vec::with_capacity(query.limit.unwrap_or(3));
         if let Some(limit) = query.limit {
             results.reserve(limit);
@@ -275,6 +316,7 @@ impl IndexReady {
         let index = &self.0;
         let max_distance: usize = query.max_distance.unwrap_or(usize::MAX);
         let limit: usize = query.limit.unwrap_or(usize::MAX);
+        let must_sketch = utils::TokenSketch::new(&query.must);
 
         let phrases_by_score = heatmap.phrases
             .iter()
@@ -296,34 +338,38 @@ impl IndexReady {
                     &(heat_a.total_score, should_a, phrase_b.origin.len())).unwrap_or(Ordering::Equal)
             });
 
-        for (phrase_idx, phrase_heatmap, phrase, should_score) in phrases_by_score {
-            /* Iterate over potential phrases */
+        /* Drop scanning if the total score dropped below the cutoff*leader.
+         * If the score is too low - it won't grow. */
+        let min_score = query.scan_cutoff * heatmap.max_score;
+        let candidates: Vec<_> = phrases_by_score
+            .take_while(|(_, phrase_heatmap, _, _)| phrase_heatmap.total_score >= min_score)
+            .collect();
 
-            /* Drop scanning if the total score dropped below the cutoff*leader. */
-            if phrase_heatmap.total_score < query.scan_cutoff * heatmap.max_score {
-                // If the score is too low - it won't grow.
-                break;
-            }
+        let find_token = |phrase_heatmap: &PhraseHeatmap, phrase: &'a PhraseEntry| {
+            Self::valid_token(query, &must_sketch, max_distance, phrase_heatmap, phrase)
+        };
 
-            /* Iterate over tokens by decreasing trigram score until first matching is found */
-            let valid_token = phrase_heatmap.tokens
-                .iter()
-                .map(|(&idx, &score)|
-                     (score, &phrase.tokens[idx as usize]))
-                .sorted_by(|(score_a, token_a), (score_b, token_b)| {
-                    /* Prefer shortest for a given score */
-                    /* TODO: Maybe score could be divided by token length */
-                    let side_a = (score_a, token_b.len());
-                    let side_b = (score_b, token_a.len());
-                    side_b.partial_cmp(&side_a).unwrap_or(Ordering::Equal)
-                })
-                .map(|(token_score, token)| {
-                    let distance = utils::distance(token, &query.must);
-                    (token, token_score, distance)
-                }).find(|(_token, _score, distance)| {
-                    *distance <= max_distance
-                });
+        /* Phrases are matched independently, so large candidate sets can be
+         * matched in parallel. Chunks keep the limit cutting the scan short. */
+        #[cfg(feature = "rayon")]
+        let matches = if query.parallel && candidates.len() > PARALLEL_CANDIDATES {
+            Either::Left(candidates.chunks(PARALLEL_CANDIDATES).flat_map(|chunk| {
+                let tokens: Vec<_> = chunk.par_iter()
+                    .map(|candidate| find_token(candidate.1, candidate.2))
+                    .collect();
+                chunk.iter().zip(tokens)
+            }))
+        } else {
+            Either::Right(candidates.iter().map(|candidate| {
+                (candidate, find_token(candidate.1, candidate.2))
+            }))
+        };
+        #[cfg(not(feature = "rayon"))]
+        let matches = candidates.iter().map(|candidate| {
+            (candidate, find_token(candidate.1, candidate.2))
+        });
 
+        for ((phrase_idx, _, phrase, should_score), valid_token) in matches {
             if let Some((token, token_score, distance)) = valid_token {
                 /* Add result based on best token matching this phrase (lowest
                  * distance, highest score) */
@@ -331,9 +377,9 @@ impl IndexReady {
                 results.push(
                     Result {
                         origin: &phrase.origin,
-                        index: *phrase_idx,
+                        index: **phrase_idx,
                         score: token_score,
-                        should_score,
+                        should_score: *should_score,
                         token,
                         distance,
                     });
@@ -359,6 +405,18 @@ impl IndexReady {
         let should_scores = self.should_scores(&heatmap, &query.should);
         self.filtered_results(query, &heatmap, should_scores)
     }
+
+    /// Run multiple queries, on the rayon thread pool when `parallel` is set
+    /// and built with rayon. Results are in order of queries.
+    pub fn search_batch(&self, queries: &[Query], parallel: bool) -> Vec<Vec<Result>> {
+        #[cfg(feature = "rayon")]
+        if parallel {
+            return queries.par_iter().map(|query| self.search(query)).collect();
+        }
+        #[cfg(not(feature = "rayon"))]
+        let _ = parallel;
+        queries.iter().map(|query| self.search(query)).collect()
+    }
 }
 
 
@@ -468,4 +526,55 @@ mod tests {
         assert_eq!(results.len(), 1);
         assert_eq!(results[0].index, 3);
     }
+
+    #[test]
+    fn it_searches_in_batch() {
+        let mut idx = super::Index::new();
+        idx.add_phrase("Warsaw", 1, None);
+        idx.add_phrase("Wrocław", 2, None);
+        idx.add_phrase("Kraków", 3, None);
+        let idx = idx.finish();
+
+        let queries = [
+            Query::new("warszawa", &[]).limit(Some(1)),
+            Query::new("krakow", &[]).limit(Some(1)),
+            Query::new("gdansk", &[]).limit(Some(1)),
+        ];
+        let batch = idx.search_batch(&queries, false);
+        assert_eq!(batch.len(), queries.len());
+        for (query, results) in queries.iter().zip(batch.iter()) {
+            println!("Querying {:?} got {:?}", query, results);
+            assert_eq!(*results, idx.search(query));
+        }
+        assert_eq!(idx.search_batch(&queries, true), batch);
+        assert_eq!(batch[0][0].index, 1);
+        assert_eq!(batch[1][0].index, 3);
+        assert!(batch[2].is_empty());
+    }
+
+    /// Large candidate sets are matched in chunks (in parallel with rayon, when asked).
+    #[test]
+    fn it_works_with_many_candidates() {
+        let mut idx = super::Index::new();
+        for i in 0..300 {
+            idx.add_phrase(&format!("Main street {}", i), i, None);
+        }
+        idx.add_phrase("Mainz", 300, None);
+        let idx = idx.finish();
+
+        let results = idx.search(&Query::new("main", &[]).limit(Some(200)));
+        assert_eq!(results.len(), 200);
+        let indices: HashSet<usize> = results.iter().map(|result| result.index).collect();
+        assert_eq!(indices.len(), 200);
+
+        let parallel_results = idx.search(&Query::new("main", &[]).limit(Some(200)).parallel(true));
+        assert_eq!(parallel_results, results);
+
+        let results = idx.search(&Query::new("main", &[]).limit(None));
+        assert_eq!(results.len(), 301);
+        assert_eq!(idx.search(&Query::new("main", &[]).limit(None).parallel(true)), results);
+        /* Sorted by distance */
+        assert_eq!(results.last().unwrap().index, 300);
+        assert_eq!(results.last().unwrap().distance, 1);
+    }
 }
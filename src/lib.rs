@@ -59,40 +59,102 @@ impl FuzzDex {
                   must: &str, should: Vec<&str>,
                   constraint: Option<usize>, limit: Option<usize>,
                   max_distance: Option<usize>,
-                  scan_cutoff: Option<f32>) -> PyResult<PyObject> {
+                  scan_cutoff: Option<f32>,
+                  parallel: Option<bool>) -> PyResult<PyObject> {
+        let index = self.ready()?;
+        let query = Self::build_query(must, &should, constraint, max_distance, limit, scan_cutoff)
+            .parallel(parallel.unwrap_or(false));
+
+        let search_results = py.allow_threads(
+            move || {
+                index.search(&query)
+            });
+        Ok(results_to_py(py, &search_results).into())
+    }
+
+    /// Same as search(), but returns only a list of matched phrase indices.
+    fn search_ids(&self, py: Python,
+                  must: &str, should: Vec<&str>,
+                  constraint: Option<usize>, limit: Option<usize>,
+                  max_distance: Option<usize>,
+                  scan_cutoff: Option<f32>,
+                  parallel: Option<bool>) -> PyResult<Vec<usize>> {
+        let index = self.ready()?;
+        let query = Self::build_query(must, &should, constraint, max_distance, limit, scan_cutoff)
+            .parallel(parallel.unwrap_or(false));
+
+        let ids: Vec<usize> = py.allow_threads(
+            move || {
+                index.search(&query)
+                    .iter()
+                    .map(|result| result.index)
+                    .collect()
+            });
+        Ok(ids)
+    }
+
+    /// Run many queries with a single call: a list of
+    /// (must, should, constraint, max_distance, limit) tuples.
+    /// Returns a list of results for each query. With parallel=True
+    /// queries run on the rayon thread pool.
+    fn search_batch<'py>(&self, py: Python<'py>,
+                         queries: Vec<(&str, Vec<&str>, Option<usize>,
+                                       Option<usize>, Option<usize>)>,
+                         scan_cutoff: Option<f32>,
+                         parallel: Option<bool>) -> PyResult<PyObject> {
+        let index = self.ready()?;
+        let queries: Vec<query::Query> = queries.iter()
+            .map(|(must, should, constraint, max_distance, limit)| {
+                Self::build_query(must, should, *constraint, *max_distance, *limit, scan_cutoff)
+            })
+            .collect();
+
+        let batch_results = py.allow_threads(
+            || {
+                index.search_batch(&queries, parallel.unwrap_or(false))
+            });
+        let list = PyList::new(py, batch_results.iter()
+                               .map(|search_results| results_to_py(py, search_results)));
+        Ok(list.into())
+    }
+}
+
+impl FuzzDex {
+    fn ready(&self) -> PyResult<&fuzzdex::IndexReady> {
         match &self.index_ready {
             None => {
                 Err(PyErr::new::<exceptions::PyRuntimeError, _>("Index is not yet finished."))
             },
-            Some(index) => {
-                let query = query::Query::new(must, &should)
-                    .constraint(constraint)
-                    .max_distance(max_distance)
-                    .limit(limit)
-                    .scan_cutoff(scan_cutoff.unwrap_or(0.3));
-
-                let search_results = py.allow_threads(
-                    move || {
-                        index.search(&query)
-                    });
-                let pyresults = search_results.iter()
-                    .map(|result| {
-                        let pyresult = PyDict::new(py);
-                        pyresult.set_item("origin", result.origin).unwrap();
-                        pyresult.set_item("index", result.index).unwrap();
-                        pyresult.set_item("token", result.token).unwrap();
-                        pyresult.set_item("distance", result.distance).unwrap();
-                        pyresult.set_item("score", result.score).unwrap();
-                        pyresult.set_item("should_score", result.should_score).unwrap();
-                        pyresult
-                    });
-
-                let list = PyList::new(py, pyresults);
-                Ok(list.into())
-            }
+            Some(index) => Ok(index),
         }
     }
 
+    /// Build query from Python arguments; common to all search methods.
+    fn build_query(must: &str, should: &[&str],
+                   constraint: Option<usize>, max_distance: Option<usize>,
+                   limit: Option<usize>, scan_cutoff: Option<f32>) -> query::Query {
+        query::Query::new(must, should)
+            .constraint(constraint)
+            .max_distance(max_distance)
+            .limit(limit)
+            .scan_cutoff(scan_cutoff.unwrap_or(0.3))
+    }
+}
+
+/// Convert search results into a list of dictionaries.
+fn results_to_py<'py>(py: Python<'py>, search_results: &[fuzzdex::Result]) -> &'py PyList {
+    let pyresults = search_results.iter()
+        .map(|result| {
+            let pyresult = PyDict::new(py);
+            pyresult.set_item("origin", result.origin).unwrap();
+            pyresult.set_item("index", result.index).unwrap();
+            pyresult.set_item("token", result.token).unwrap();
+            pyresult.set_item("distance", result.distance).unwrap();
+            pyresult.set_item("score", result.score).unwrap();
+            pyresult.set_item("should_score", result.should_score).unwrap();
+            pyresult
+        });
+    PyList::new(py, pyresults)
 }
 
 /// Helper to calculate levenshtein distance from Python without additional libs.
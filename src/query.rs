@@ -16,6 +16,9 @@ pub struct Query {
     pub max_distance: Option<usize>,
     /// Cutoff phrase scanning when it's score is < `cutoff*max_score`.
     pub scan_cutoff: f32,
+    /// Match large candidate sets using the rayon thread pool. Opt-in, as the
+    /// pool doesn't survive a fork().
+    pub parallel: bool,
 }
 
 impl Query {
@@ -41,6 +44,7 @@ impl Query {
             limit: None,
             max_distance: Some(2),
             scan_cutoff: 0.3,
+            parallel: false,
         }
     }
 
@@ -63,4 +67,9 @@ impl Query {
         self.scan_cutoff = cutoff;
         self
     }
+
+    pub fn parallel(mut self, parallel: bool) -> Self {
+        self.parallel = parallel;
+        self
+    }
 }
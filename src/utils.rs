@@ -1,4 +1,5 @@
 use std::iter::FromIterator;
+use std::collections::HashMap;
 use regex::Regex;
 use lazy_static::lazy_static;
 
@@ -6,6 +7,8 @@ use unicode_segmentation::UnicodeSegmentation;
 use unicode_normalization::UnicodeNormalization;
 use unicode_categories::UnicodeCategories;
 
+type FastHash = ahash::RandomState;
+
 lazy_static! {
     /* NOTE: Maybe detect a unicode group for interpunction chars */
     static ref SEPARATOR: Regex = Regex::new("[- \t\n'’`„\"_.,;:=]+").expect("invalid regexp");
@@ -64,11 +67,184 @@ pub fn tokenize(phrase: &str, min_length: usize) -> Vec<String> {
     tokens
 }
 
+/// Cheap summary of a token used to reject candidates before calculating the
+/// edit distance.
+#[derive(Debug, Clone, Copy, PartialEq)]
+pub struct TokenSketch {
+    /// Length in graphemes.
+    length: usize,
+    /// Bitmap of ASCII characters used in token.
+    chars: u128,
+}
+
+impl TokenSketch {
+    pub fn new(token: &str) -> Self {
+        /* Skip \n so the two-byte \r\n grapheme sets a single bit */
+        let chars = token.bytes()
+            .filter(|&b| b.is_ascii() && b != b'\n')
+            .fold(0u128, |chars, b| chars | (1u128 << b));
+        Self {
+            length: token.graphemes(true).count(),
+            chars,
+        }
+    }
+
+    /// False if tokens are surely further apart than `max_distance`. Each
+    /// character present on only one side needs at least one edit.
+    pub fn may_match(&self, other: &Self, max_distance: usize) -> bool {
+        let k = max_distance as u32;
+        let length_diff = if self.length > other.length {
+            self.length - other.length
+        } else {
+            other.length - self.length
+        };
+        length_diff <= max_distance
+            && (self.chars & !other.chars).count_ones() <= k
+            && (other.chars & !self.chars).count_ones() <= k
+    }
+}
+
+/// Levenshtein distance between two strings, counted in graphemes.
 pub fn distance(side_a: &str, side_b: &str) -> usize {
+    distance_bounded(side_a, side_b, usize::MAX)
+}
+
+/// Levenshtein distance which may stop early once it surely exceeds
+/// `max_distance`. Exact when the result is <= max_distance, otherwise only
+/// guaranteed to be greater than max_distance.
+pub fn distance_bounded(side_a: &str, side_b: &str, max_distance: usize) -> usize {
+    /* Common case: ASCII tokens fitting a machine word. For plain ASCII each
+     * byte is a grapheme, except for a \r\n pair. */
+    if is_plain_ascii(side_a) && is_plain_ascii(side_b) {
+        let (pattern, text) = if side_a.len() <= side_b.len() {
+            (side_a.as_bytes(), side_b.as_bytes())
+        } else {
+            (side_b.as_bytes(), side_a.as_bytes())
+        };
+        if pattern.len() <= 64 {
+            let mut peq = [0u64; 256];
+            for (i, &ch) in pattern.iter().enumerate() {
+                peq[ch as usize] |= 1 << i;
+            }
+            let text_eq = text.iter().map(|&ch| peq[ch as usize]);
+            return myers_distance(pattern.len(), text_eq, max_distance);
+        }
+    }
+
     let graphemes_a = side_a.graphemes(true).collect::<Vec<&str>>();
     let graphemes_b = side_b.graphemes(true).collect::<Vec<&str>>();
-    let (distance, _) = levenshtein_diff::distance(&graphemes_a, &graphemes_b);
-    distance
+    let (pattern, text) = if graphemes_a.len() <= graphemes_b.len() {
+        (graphemes_a, graphemes_b)
+    } else {
+        (graphemes_b, graphemes_a)
+    };
+
+    if pattern.len() <= 64 {
+        /* Intern pattern graphemes into small IDs indexing the bitmasks */
+        let mut ids: HashMap<&str, u32, FastHash> =
+            HashMap::with_capacity_and_hasher(pattern.len(), FastHash::new());
+        let mut peq: Vec<u64> = Vec::with_capacity(pattern.len());
+        for (i, grapheme) in pattern.iter().enumerate() {
+            let id = *ids.entry(grapheme).or_insert_with(|| {
+                peq.push(0);
+                (peq.len() - 1) as u32
+            });
+            peq[id as usize] |= 1 << i;
+        }
+        /* Graphemes absent from the pattern match nothing */
+        let text_eq = text.iter()
+            .map(|grapheme| ids.get(grapheme).map_or(0, |&id| peq[id as usize]));
+        myers_distance(pattern.len(), text_eq, max_distance)
+    } else {
+        banded_distance(&pattern, &text, max_distance)
+    }
+}
+
+fn is_plain_ascii(token: &str) -> bool {
+    token.bytes().all(|b| b.is_ascii() && b != b'\r')
+}
+
+/// Myers' bit-parallel Levenshtein distance (Hyyrö's formulation).
+/// Pattern must be at most 64 characters long. For each text character
+/// `text_eq` yields a bitmask of pattern positions holding that character.
+fn myers_distance(pattern_len: usize, text_eq: impl ExactSizeIterator<Item = u64>,
+                  max_distance: usize) -> usize {
+    let m = pattern_len;
+    let text_len = text_eq.len();
+    if m == 0 {
+        return text_len;
+    }
+    debug_assert!(m <= 64);
+
+    /* Vertical deltas of the current column: all +1 initially */
+    let mut pv: u64 = !0;
+    let mut mv: u64 = 0;
+    let last: u64 = 1 << (m - 1);
+    let mut score = m;
+
+    for (j, eq) in text_eq.enumerate() {
+        let xv = eq | mv;
+        let xh = ((eq & pv).wrapping_add(pv) ^ pv) | eq;
+        let mut ph = mv | !(xh | pv);
+        let mut mh = pv & xh;
+        if ph & last != 0 {
+            score += 1;
+        } else if mh & last != 0 {
+            score -= 1;
+        }
+        /* Top row is distance from an empty pattern, it grows by one. */
+        ph = (ph << 1) | 1;
+        mh <<= 1;
+        pv = mh | !(xv | ph);
+        mv = ph & xv;
+
+        /* Score can drop by at most one per remaining text character */
+        let remaining = text_len - j - 1;
+        if score > max_distance.saturating_add(remaining) {
+            return score - remaining;
+        }
+    }
+    score
+}
+
+/// Dynamic programming Levenshtein distance limited to a diagonal band of
+/// `max_distance` width. `side_a` must not be longer than `side_b`.
+fn banded_distance<T: PartialEq>(side_a: &[T], side_b: &[T], max_distance: usize) -> usize {
+    let (n, m) = (side_a.len(), side_b.len());
+    if m - n > max_distance {
+        return m - n;
+    }
+    /* Distance won't exceed the longer length; also keeps `over` from overflowing */
+    let max_distance = max_distance.min(m);
+    let over = max_distance + 1;
+
+    let mut prev: Vec<usize> = (0..=m).map(|j| j.min(over)).collect();
+    let mut cur: Vec<usize> = vec![over; m + 1];
+    for i in 1..=n {
+        let low = if i > max_distance { i - max_distance } else { 1 };
+        let high = m.min(i + max_distance);
+        /* Left of the band */
+        cur[low - 1] = if low == 1 { i.min(over) } else { over };
+        let mut row_min = cur[low - 1];
+        for j in low..=high {
+            let cost = if side_a[i - 1] == side_b[j - 1] { 0 } else { 1 };
+            let value = (prev[j - 1] + cost)
+                .min(prev[j] + 1)
+                .min(cur[j - 1] + 1)
+                .min(over);
+            cur[j] = value;
+            row_min = row_min.min(value);
+        }
+        /* Right of the band, read by the next row */
+        if high < m {
+            cur[high + 1] = over;
+        }
+        if row_min > max_distance {
+            return over;
+        }
+        std::mem::swap(&mut prev, &mut cur);
+    }
+    prev[m]
 }
 
 #[cfg(test)]
@@ -107,4 +283,58 @@ mod tests {
             }
         }
     }
+
+    #[test]
+    fn it_calculates_distance() {
+        let testcases = [
+            ("oneword", "oneword", 0),
+            ("oneword", "oneWord", 1),
+            ("oneword", "onewXord", 1),
+            ("onword", "onewoXrd", 2),
+            ("", "abc", 3),
+            ("kitten", "sitting", 3),
+            ("a\r\nb", "ab", 1),
+            ("żółw", "zolw", 3),
+            ("y̆es", "yes", 1),
+        ];
+        for (side_a, side_b, proper) in testcases.iter() {
+            println!("Testing {} / {}", side_a, side_b);
+            assert_eq!(distance(side_a, side_b), *proper);
+            assert_eq!(distance(side_b, side_a), *proper);
+        }
+
+        /* Bit-parallel and the generic path must agree */
+        let long_a = "abcdefghij".repeat(6) + "xyz";
+        let long_b = "abcdefghij".repeat(6) + "xz";
+        let graphemes_a = long_a.graphemes(true).collect::<Vec<&str>>();
+        let graphemes_b = long_b.graphemes(true).collect::<Vec<&str>>();
+        let (proper, _) = levenshtein_diff::distance(&graphemes_a, &graphemes_b);
+        assert_eq!(distance(&long_a, &long_b), proper);
+
+        /* Sketch never rejects tokens within distance */
+        for (side_a, side_b, proper) in testcases.iter() {
+            let sketch_a = TokenSketch::new(side_a);
+            let sketch_b = TokenSketch::new(side_b);
+            assert!(sketch_a.may_match(&sketch_b, *proper));
+        }
+        let sketch = TokenSketch::new("warszawa");
+        assert!(!sketch.may_match(&TokenSketch::new("gdansk"), 2));
+        assert!(!sketch.may_match(&TokenSketch::new("wa"), 2));
+
+        /* Non-ASCII tokens, short and longer than 64 graphemes */
+        let long_a = "żółw".repeat(20);
+        let long_b = "zółw".repeat(19) + "zólw";
+        let graphemes_a = long_a.graphemes(true).collect::<Vec<&str>>();
+        let graphemes_b = long_b.graphemes(true).collect::<Vec<&str>>();
+        let (proper, _) = levenshtein_diff::distance(&graphemes_a, &graphemes_b);
+        assert_eq!(distance(&long_a, &long_b), proper);
+        assert_eq!(proper, 21);
+        assert_eq!(distance(&"żółw".repeat(5), &"zółw".repeat(5)), 5);
+        assert!(distance_bounded(&long_a, &long_b, 2) > 2);
+        assert_eq!(distance_bounded(&long_a, &long_b, 25), proper);
+
+        /* Bounded distance stops early, but stays above the bound */
+        assert!(distance_bounded("aaaaaaaa", "bbbbbbbb", 2) > 2);
+        assert_eq!(distance_bounded("kitten", "sitting", 3), 3);
+    }
 }
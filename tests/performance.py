@@ -3,31 +3,101 @@
 """
 Called manually, but requires OSM data exported with
 https://github.com/exatel/topo_import in .csv.gz file
+
+Query glue is type-annotated, so it can be compiled to reduce the
+interpreter overhead around Rust calls:
+$ mypyc tests/performance.py
 """
 
+import io
 import gzip
+import subprocess
+import struct
+import sys
 import csv
+import functools
 from time import time
 import random
-import fuzzdex
+import math
+from array import array
+import fuzzdex  # type: ignore
 import pickle
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
 from dataclasses import dataclass, field
-from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor
-from multiprocessing import Pool
-
-
-config = {'limit': 30}
-
-
-@dataclass
-class Address:
-    housenumber: str
-    lon: str
-    lat: str
-    postcode: str
-
-@dataclass
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing as mp
+import threading
+
+try:
+    # Faster DEFLATE implementation, optional.
+    from isal import igzip as gzip_impl  # type: ignore
+except ImportError:
+    gzip_impl = gzip
+
+
+# Shared with workers; compiled functions can't keep attributes.
+# `rayon` marks that rayon's thread pool was started in this process.
+# `barrier` holds workers until all of them are started.
+config: Dict[str, Any] = {'limit': 30, 'idx': None, 'rayon': False, 'barrier': None}
+
+# Decompressor reads in small blocks by default.
+READ_BUFFER_SIZE = 1 << 20
+
+PICKLE_PATH = "pickle-dump.pickle.gz"
+# Large arrays are stored uncompressed, out of the pickle stream.
+BUFFERS_PATH = "pickle-dump.buffers"
+
+# Drop per-instance __dict__ (Python 3.10+).
+SLOTS = {'slots': True} if sys.version_info >= (3, 10) else {}
+
+
+class Addresses:
+    """
+    All addresses stored column-wise; rows are referenced by index.
+    Housenumbers are only kept in tree keys.
+    """
+    __slots__ = ("lon", "lat", "postcode")
+
+    def __init__(self):
+        self.lon = array("d")
+        self.lat = array("d")
+        self.postcode = []
+
+    def __len__(self):
+        return len(self.lon)
+
+    def append(self, lon, lat, postcode):
+        """Add address, return its row."""
+        self.lon.append(float(lon) if lon else math.nan)
+        self.lat.append(float(lat) if lat else math.nan)
+        self.postcode.append(postcode)
+        return len(self.lon) - 1
+
+    def get(self, row):
+        """Read a single address as (lon, lat, postcode) tuple."""
+        return self.lon[row], self.lat[row], self.postcode[row]
+
+    def __reduce_ex__(self, protocol):
+        lon, lat = self.lon, self.lat
+        if protocol >= 5:
+            # Allow out-of-band transfer of arrays
+            lon, lat = pickle.PickleBuffer(lon), pickle.PickleBuffer(lat)
+        return Addresses._restore, (lon, lat, self.postcode)
+
+    @classmethod
+    def _restore(cls, lon, lat, postcode):
+        addresses = cls()
+        # Got bytes, pickle buffers or arrays; view all as bytes.
+        addresses.lon.frombytes(memoryview(lon).cast("B"))
+        addresses.lat.frombytes(memoryview(lat).cast("B"))
+        addresses.postcode = postcode
+        if not len(addresses.lon) == len(addresses.lat) == len(postcode):
+            raise ValueError("Address columns differ in length")
+        return addresses
+
+
+@dataclass(**SLOTS)
 class Entry:
     eid: int
     name: str
@@ -39,11 +109,73 @@ class Index:
     cities: fuzzdex.FuzzDex
     streets: fuzzdex.FuzzDex
     tree: dict
+    addresses: Addresses
+
+
+def open_gz(path, mode="rb"):
+    """Open gzip file; reads go through a large buffer."""
+    if "r" not in mode:
+        return gzip_impl.open(path, mode)
+    gz = io.BufferedReader(gzip_impl.open(path, "rb"),
+                           buffer_size=READ_BUFFER_SIZE)
+    if "t" in mode:
+        return io.TextIOWrapper(gz, encoding="utf-8", newline="")
+    return gz
+
+
+@contextmanager
+def open_gz_pipe(path):
+    """
+    Decompress text in a separate pigz process, outside of the GIL.
+    Fall back to open_gz() when pigz is not installed.
+    """
+    try:
+        proc = subprocess.Popen(["pigz", "-dc", path], stdout=subprocess.PIPE,
+                                bufsize=READ_BUFFER_SIZE)
+    except FileNotFoundError:
+        with open_gz(path, "rt") as stream:
+            yield stream
+        return
+
+    try:
+        yield io.TextIOWrapper(proc.stdout, encoding="utf-8", newline="")
+    finally:
+        proc.stdout.close()
+        if proc.wait() not in (0, -13):
+            # -13 is SIGPIPE when the reader stopped early.
+            raise RuntimeError(f"pigz failed with code {proc.returncode}")
+
+
+def dump_buffers(path, buffers):
+    """Write pickle out-of-band buffers, each prefixed with its size."""
+    with open(path, "wb") as f:
+        for buffer in buffers:
+            raw = buffer.raw()
+            f.write(struct.pack("<Q", raw.nbytes))
+            f.write(raw)
+
+
+def load_buffers(path):
+    """Read buffers written by dump_buffers()."""
+    buffers = []
+    with open(path, "rb") as f:
+        header = f.read(8)
+        while header:
+            if len(header) != 8:
+                raise ValueError(f"{path}: truncated buffer header")
+            (size,) = struct.unpack("<Q", header)
+            buffer = bytearray(size)
+            if f.readinto(buffer) != size:
+                raise ValueError(f"{path}: truncated buffer, expected {size} bytes")
+            buffers.append(buffer)
+            header = f.read(8)
+    return buffers
 
 
 def read_csv():
     """Read CSV, generate Pickle."""
-    tree = defaultdict(lambda: {})
+    tree = {}
+    addresses = Addresses()
 
     cities = {}
     streets = {}
@@ -53,7 +185,7 @@ def read_csv():
 
     test_data = []
 
-    with gzip.open("osm-export.csv.gz", "rt") as csvgz:
+    with open_gz_pipe("osm-export.csv.gz") as csvgz:
         reader = csv.reader(csvgz)
         _ = next(reader)
 
@@ -61,9 +193,9 @@ def read_csv():
         for i, row in enumerate(reader):
             city_name, postcode, street_name, housenumber = row[2:6]
             lon, lat = row[8], row[9]
-
-            address = Address(housenumber=housenumber,
-                              lon=lon, lat=lat, postcode=postcode)
+            # Few distinct values; share them and their cached hashes.
+            housenumber = sys.intern(housenumber)
+            postcode = sys.intern(postcode)
 
             # Get/create city and street:
             city = cities.get(city_name)
@@ -91,27 +223,39 @@ def read_csv():
             if i % 2000 == 0:
                 test_data.append((city_name, street_name, housenumber))
 
-            tree[(city.eid, street_id)][address.housenumber] = address
+            # Both ids fit in 32 bits; an int key hashes to itself.
+            key = (city.eid << 32) | street_id
+            tree[(key, housenumber)] = addresses.append(lon, lat, postcode)
 
             if (i+1) % 100000 == 0:
                 print(f"Loaded {i+1} rows, {len(cities)} cities, {len(streets)} streets.")
 
     start = time()
-    tree = dict(tree)
     random.shuffle(test_data)
-    with gzip.open("pickle-dump.pickle.gz", "wb") as gz:
-        pickle.dump((cities, streets, tree, test_data), gz)
+    buffers = []
+    with open_gz(PICKLE_PATH, "wb") as gz:
+        pickle.dump((cities, streets, tree, addresses, test_data), gz,
+                    protocol=5, buffer_callback=buffers.append)
+    dump_buffers(BUFFERS_PATH, buffers)
     print(f"Pickle dump took {time() - start}")
     return
 
 
 def load():
     """Load pickle and index data."""
-    # city -> street -> housenumber -> Address
-    # (city, street) -> housenumber -> Address?
+    # ((city << 32) | street, housenumber) -> row in Addresses
     start = time()
-    with gzip.open("pickle-dump.pickle.gz", "rb") as gz:
-        cities, streets, tree, test_data = pickle.load(gz)
+    try:
+        buffers = iter(load_buffers(BUFFERS_PATH))
+        with open_gz(PICKLE_PATH, "rb") as gz:
+            cities, streets, tree, addresses, test_data = pickle.load(
+                gz, buffers=buffers)
+    except (pickle.UnpicklingError, ValueError) as ex:
+        raise RuntimeError(f"{BUFFERS_PATH} doesn't match {PICKLE_PATH}, "
+                           "regenerate both with read_csv()") from ex
+    if next(buffers, None) is not None:
+        raise RuntimeError(f"{BUFFERS_PATH} has more buffers than {PICKLE_PATH} "
+                           "uses, regenerate both with read_csv()")
     print(f"Unpickle took {time() - start}")
 
     print("Building fuzzdex index")
@@ -128,43 +272,63 @@ def load():
         street_idx.add_phrase(street.name, street.eid, street.constraints)
     street_idx.finish()
     print(f"Build took {time() - start}")
-    idx = Index(cities=city_idx, streets=street_idx, tree=tree)
+    idx = Index(cities=city_idx, streets=street_idx, tree=tree,
+                addresses=addresses)
 
     return (idx, test_data)
 
 
-def prepare(phrase):
-    tokens = fuzzdex.tokenize(phrase)
-    tokens.sort(key=len, reverse=True)
-    if not tokens:
-        return phrase, []
-    return tokens[0], tokens[1:]
+# (must, should) tokens and a (city, street, housenumber) prepared query.
+Prepared = Tuple[str, Tuple[str, ...]]
+Query = Tuple[Prepared, Optional[Prepared], str]
 
 
-def scan_streets(idx, street, city_id, housenumber, limit):
-    must, should = prepare(street)
-    streets = idx.streets.search(must, should, constraint=city_id,
-                                 max_distance=2, limit=limit)
-    if not streets:
+@functools.lru_cache(maxsize=None)
+def prepare(phrase: str) -> Prepared:
+    """Split phrase into must and should tokens. Cached, as phrases repeat."""
+    tokens = fuzzdex.tokenize(phrase)
+    if not tokens:
+        return phrase, ()
+    if len(tokens) == 1:
+        return tokens[0], ()
+    # Longest token is the must token; order of should tokens doesn't matter.
+    longest = max(range(len(tokens)), key=lambda i: len(tokens[i]))
+    return tokens[longest], tuple(tokens[:longest] + tokens[longest + 1:])
+
+
+def prepare_all(test_data) -> List[Query]:
+    """Tokenize all queries once: [(city, street or None, housenumber)]."""
+    return [
+        (prepare(city), prepare(street) if street else None,
+         sys.intern(housenumber))
+        for city, street, housenumber in test_data
+    ]
+
+
+def scan_streets(idx: Index, street: Prepared, city_id: int,
+                 housenumber: str, limit: int) -> bool:
+    must, should = street
+    street_ids = idx.streets.search_ids(must, should, constraint=city_id,
+                                        max_distance=2, limit=limit)
+    if not street_ids:
         return False
 
-    for street_solution in streets:
-        street_id = street_solution["index"]
-        data = idx.tree.get((city_id, street_id), {}).get(housenumber)
-        if data:
+    city_key: int = city_id << 32
+    for street_id in street_ids:
+        if (city_key | street_id, housenumber) in idx.tree:
             return True
     return False
 
 
-def scan_city(idx, city, street, housenumber, limit=20):
-    must, should = prepare(city)
-    cities = idx.cities.search(must, should, max_distance=2, limit=limit)
-    for city_solution in cities:
-        city_id = city_solution["index"]
+def scan_city(idx: Index, city: Prepared, street: Optional[Prepared],
+              housenumber: str, limit: int = 20) -> bool:
+    """Scan prepared (must, should) city and optional street."""
+    must, should = city
+    city_ids = idx.cities.search_ids(must, should, max_distance=2, limit=limit)
+    for city_id in city_ids:
         if not street:
-            street_id = 0
-            data = idx.tree.get((city_id, street_id), {}).get(housenumber)
-            if data is not None:
+            # No street: street_id == 0
+            if (city_id << 32, housenumber) in idx.tree:
                 return True
             continue
 
@@ -173,11 +337,60 @@ def scan_city(idx, city, street, housenumber, limit=20):
     return False
 
 
-def test_geo(idx, test_data, limit=20):
+def scan_city_batch(idx: Index, queries: List[Query], limit: int = 20,
+                    parallel: bool = False) -> List[bool]:
+    """
+    scan_city() for many queries, with one Rust call per round. Round N
+    scans streets of the N-th city candidate of still unresolved queries, so
+    it searches only as much as scan_city() would.
+    """
+    cities = idx.cities.search_batch([
+        (must, should, None, 2, limit) for (must, should), _, _ in queries
+    ], parallel=parallel)
+    city_ids = [[city_solution["index"] for city_solution in city_solutions]
+                for city_solutions in cities]
+
+    found = [False] * len(queries)
+    # Queries with a street, which are not yet found
+    pending = []
+    for no, (_, street, housenumber) in enumerate(queries):
+        if street:
+            pending.append(no)
+            continue
+        # No street: street_id == 0
+        found[no] = any((city_id << 32, housenumber) in idx.tree
+                        for city_id in city_ids[no])
+
+    depth = 0
+    while pending:
+        pending = [no for no in pending if depth < len(city_ids[no])]
+        street_queries = []
+        for no in pending:
+            street = queries[no][1]
+            assert street is not None
+            must, should = street
+            street_queries.append((must, should, city_ids[no][depth], 2, limit))
+
+        streets = idx.streets.search_batch(street_queries, parallel=parallel)
+        unresolved = []
+        for no, street_solutions in zip(pending, streets):
+            city_key: int = city_ids[no][depth] << 32
+            housenumber = queries[no][2]
+            if any((city_key | street_solution["index"], housenumber) in idx.tree
+                   for street_solution in street_solutions):
+                found[no] = True
+            else:
+                unresolved.append(no)
+        pending = unresolved
+        depth += 1
+    return found
+
+
+def test_geo(idx, queries, limit=20):
     s = time()
     found = 0
     not_found = 0
-    for i, (city, street, housenumber) in enumerate(test_data):
+    for i, (city, street, housenumber) in enumerate(queries):
         got = scan_city(idx, city, street, housenumber, limit=limit)
         if got:
             found += 1
@@ -189,51 +402,134 @@ def test_geo(idx, test_data, limit=20):
             print(f"DID {i} in {took} {i / took}/s")
 
     took = time() - s
-    print(f"DID {len(test_data)} in {took}")
+    print(f"DID {len(queries)} in {took}")
     print(f"found={found} not_found={not_found}")
 
 
-def do(entry):
-    "For parallel mapping"
-    city, street, housenumber = entry
-    if scan_city(do.idx, city, street, housenumber, limit=config['limit']):
+def do(query: Query) -> int:
+    "For parallel mapping of prepared queries"
+    city, street, housenumber = query
+    idx: Index = config['idx']
+    if scan_city(idx, city, street, housenumber, limit=config['limit']):
         return 1
     else:
         return 0
 
 
-def test_parallel(idx, test_data, workers=8, limit=20):
-    executor = ThreadPoolExecutor(max_workers=workers)
+def process_chunk(chunk: List[Query]) -> int:
+    "Scan a chunk of prepared queries, return number of found ones"
+    idx: Index = config['idx']
+    limit: int = config['limit']
+    return sum(scan_city_batch(idx, chunk, limit=limit))
+
+
+def mp_context():
+    """
+    Forked workers share the loaded index, but rayon's thread pool doesn't
+    survive a fork(). Once it was started here, use a forkserver instead.
+    """
+    if config['rayon']:
+        return mp.get_context("forkserver")
+    return mp.get_context("fork")
+
+
+def init_worker(limit, barrier):
+    """Set up worker; load the index unless it was inherited by fork."""
     config['limit'] = limit
+    config['barrier'] = barrier
+    if config['idx'] is None:
+        config['idx'], _ = load()
+
+
+def wait_started(_=None):
+    "Run once per worker; returns when all workers are started and set up"
+    config['barrier'].wait(timeout=600)
+
+
+def split(data, parts):
+    "Split list into at most `parts` continuous chunks"
+    size = max(1, -(-len(data) // parts))
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def test_parallel(idx, queries, workers=8, limit=20, processes=True):
+    """
+    Scan prepared queries in parallel. By default uses forked processes which share
+    the index copy-on-write; processes=False uses threads.
+    """
+    config['limit'] = limit
+    # Set before forking, so workers inherit the index without pickling.
+    config['idx'] = idx
+    if processes:
+        ctx = mp_context()
+        executor = ProcessPoolExecutor(max_workers=workers,
+                                       mp_context=ctx,
+                                       initializer=init_worker,
+                                       initargs=(limit, ctx.Barrier(workers)))
+        kind = "processes"
+    else:
+        config['barrier'] = threading.Barrier(workers)
+        executor = ThreadPoolExecutor(max_workers=workers)
+        kind = "threads"
+    # Few tasks per worker; amortizes dispatch and IPC over a chunk.
+    chunks = split(queries, workers * 4)
+
+    # Workers are started lazily; start them all before timing.
+    for future in [executor.submit(wait_started) for _ in range(workers)]:
+        future.result()
 
     s = time()
-    do.idx = idx
-    results = executor.map(do, test_data)
-    results = list(results)
-    found = sum(results)
+    futures = [executor.submit(process_chunk, chunk) for chunk in chunks]
+    found = sum(future.result() for future in futures)
     took = time() - s
+    executor.shutdown()
 
-    cnt = len(test_data)
-    print(f"DID {cnt} on {workers} threads in {took:.3f}, "
-          f"{cnt / took:.2f}/s ({cnt/took/workers:.1f} per thread), "
-          f"{took / cnt * 1000:.4f}ms/q ({found}/{len(results)})")
+    cnt = len(queries)
+    print(f"DID {cnt} on {workers} {kind} in {took:.3f}, "
+          f"{cnt / took:.2f}/s ({cnt/took/workers:.1f} per worker), "
+          f"{took / cnt * 1000:.4f}ms/q ({found}/{cnt})")
 
 
-def test_parallel_mp(idx, test_data, workers=8, limit=20, chunk_size=None):
-    pool = Pool(processes=workers)
+def test_parallel_mp(idx, queries, workers=8, limit=20, chunk_size=None):
     config['limit'] = limit
+    config['idx'] = idx
+    # Forked workers inherit the index, others load it.
+    ctx = mp_context()
+    pool = ctx.Pool(processes=workers, initializer=init_worker,
+                    initargs=(limit, ctx.Barrier(workers)))
+    pool.map(wait_started, range(workers), chunksize=1)
+
+    if chunk_size is None:
+        # ~16 chunks per worker balance load; large chunks limit IPC.
+        chunk_size = max(64, len(queries) // (workers * 16))
 
     s = time()
-    do.idx = idx
-    results = pool.map(do, test_data, chunk_size)
-    results = list(results)
-    found = sum(results)
+    found = sum(pool.imap_unordered(do, queries, chunk_size))
     took = time() - s
+    pool.close()
+    pool.join()
 
-    cnt = len(test_data)
+    cnt = len(queries)
     print(f"DID {cnt} on {workers} processes in {took:.3f}, "
           f"{cnt / took:.2f}/s ({cnt/took/workers:.1f} per process), "
-          f"{took / cnt * 1000:.4f}ms/q ({found}/{len(results)})")
+          f"{took / cnt * 1000:.4f}ms/q ({found}/{cnt})")
+
+
+def test_batch(idx, queries, limit=20):
+    """
+    Scan all prepared queries with batch calls run on the rayon thread pool.
+    Reported separately, as the pool uses all CPUs.
+    """
+    # Workers forked after now would inherit a broken rayon pool.
+    config['rayon'] = True
+    s = time()
+    found = sum(scan_city_batch(idx, queries, limit=limit, parallel=True))
+    took = time() - s
+
+    cnt = len(queries)
+    print(f"DID {cnt} in batch on rayon pool in {took:.3f}, "
+          f"{cnt / took:.2f}/s, "
+          f"{took / cnt * 1000:.4f}ms/q ({found}/{cnt})")
 
 
 def main():
@@ -244,15 +540,27 @@ def main():
     took = time() - start
     print(f"Data loaded in {took}")
 
+    # Tokenize once for all the runs.
+    start = time()
+    queries = prepare_all(test_data)
+    print(f"Queries prepared in {time() - start}")
+
+    # In this process; forked workers inherit the warm cache.
     print("Pre-heat cache:")
-    test_parallel(idx, test_data, workers=1)
+    test_parallel(idx, queries, workers=1, processes=False)
     print("OK:")
     wrks = [1, 2, 3, 4, 5, 6, 8, 12, 16]
     for wrk in wrks:
-        test_parallel(idx, test_data, workers=wrk)
+        test_parallel(idx, queries, workers=wrk)
 
     for wrk in wrks:
-        test_parallel_mp(idx, test_data, workers=wrk)
+        test_parallel(idx, queries, workers=wrk, processes=False)
+
+    for wrk in wrks:
+        test_parallel_mp(idx, queries, workers=wrk)
+
+    # Last, as processes can't be forked safely after it.
+    test_batch(idx, queries)
 
 
 if __name__ == "__main__":
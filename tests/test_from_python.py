@@ -57,6 +57,64 @@ def test_parallel():
     assert len(indices) == len(set(indices))
 
 
+def test_search_ids():
+    """Test returning only matched indices."""
+    fud = fuzzdex.FuzzDex()
+    fud.add_phrase("Czerniakowska", 1, constraints={1})
+    fud.add_phrase("Czerniawska", 4, constraints={2})
+    fud.add_phrase("Nowy Świat", 2, constraints={1})
+    fud.finish()
+
+    for must, should, constraint in [("czerniawska", [], None),
+                                     ("czerniawska", [], 1),
+                                     ("nowy", ["świat"], None),
+                                     ("nowy", ["świat"], 2)]:
+        results = fud.search(must, should, constraint=constraint, max_distance=2)
+        ids = fud.search_ids(must, should, constraint=constraint, max_distance=2)
+        assert ids == [result['index'] for result in results]
+    assert fud.search_ids("czerniawska", [], max_distance=2) == [4, 1]
+
+
+def test_search_parallel():
+    """Test parallel matching of many candidates returns the same results."""
+    fud = fuzzdex.FuzzDex()
+    for i in range(300):
+        fud.add_phrase(f"Main Street {i}", i, constraints={1})
+    fud.finish()
+
+    for limit in [10, 200, None]:
+        results = fud.search("main", [], limit=limit)
+        assert fud.search("main", [], limit=limit, parallel=True) == results
+        assert fud.search_ids("main", [], limit=limit, parallel=True) == \
+            [result['index'] for result in results]
+
+
+def test_search_batch():
+    """Test batch search returns the same as separate searches."""
+    fud = fuzzdex.FuzzDex()
+    fud.add_phrase("Warsaw", 1, constraints={1})
+    fud.add_phrase("Wrocław", 2, constraints={2})
+    fud.add_phrase("Nowy Świat", 3, constraints={1})
+    fud.finish()
+
+    queries = [
+        ("warszawa", [], None, 2, 10),
+        ("nowy", ["świat"], 1, 2, None),
+        ("nowy", ("świat",), 2, 2, None),
+        ("wroclaw", [], None, 1, 1),
+    ]
+    results = fud.search_batch(queries)
+    assert len(results) == len(queries)
+    for (must, should, constraint, max_distance, limit), result in zip(queries, results):
+        assert result == fud.search(must, list(should), constraint=constraint,
+                                    max_distance=max_distance, limit=limit)
+    assert results[0][0]['index'] == 1
+    assert results[1][0]['index'] == 3
+    assert results[2] == []
+    assert fud.search_batch(queries, parallel=True) == results
+    assert fud.search_batch([]) == []
+
+
 def test_distance():
     """Test helper distance method."""
     assert fuzzdex.distance("oneword", "oneword") == 0